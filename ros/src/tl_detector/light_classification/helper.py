@@ -79,6 +79,35 @@ def gen_batch_function(data_folder, image_shape):
 
     return get_batches_fn
 
+def get_calibration_paths(data_folder, count):
+    """
+    Pick the training images used to calibrate a quantized model
+    :param data_folder: Path to folder that contains all the datasets
+    :param count: Number of images to pick
+    :return: list of image paths; the same sample of every class on each call
+    """
+    image_paths = sorted(glob(os.path.join(data_folder, 't*', '*.jpg')))
+    random.Random(0).shuffle(image_paths)
+    return image_paths[:count]
+
+def gen_representative_dataset(data_folder, image_shape, count):
+    """
+    Generate function to yield model inputs for calibrating a quantized model
+    :param data_folder: Path to folder that contains all the datasets
+    :param image_shape: Tuple - Shape of image
+    :param count: Number of images to yield
+    :return: Generator function yielding a list with one float32 input batch
+    """
+    image_paths = get_calibration_paths(data_folder, count)
+
+    def representative_dataset():
+        for image_file in image_paths:
+            image = scipy.misc.imresize(scipy.misc.imread(image_file), image_shape)
+            # same scaling as the int8 placeholder + convert_image_dtype the model was trained with
+            yield [image[np.newaxis].astype(np.int8).astype(np.float32) / 127.0]
+
+    return representative_dataset
+
 def run_test_data(data_folder, image_shape, input_image, logits, count, training_mode, sess):
 
     image_paths = glob(os.path.join(data_folder, 't*', '*.jpg'))
@@ -5,6 +5,7 @@ from tensorflow.python.saved_model import constants
 from tensorflow.python.saved_model import loader
 from tensorflow.python.saved_model import tag_constants
 from tensorflow.python.saved_model import utils
+import sys
 import time
 import numpy as np
 
@@ -183,6 +184,37 @@ def run():
         helper.run_test_data(test_data_dir, image_shape, image_input_placeholder, model_output, 100, training_mode, sess)
 
 
+def export_tflite(checkpoint, output_file, data_dir, image_shape, calibration_count=100):
+    """
+    Convert the trained model to a fully quantized INT8 TFLite flatbuffer for CPU inference
+    :param checkpoint: Path of the trained checkpoint
+    :param output_file: Path of the .tflite file to write
+    :param data_dir: Path to folder with the training images used for calibration
+    :param image_shape: Tuple - Shape of image
+    :param calibration_count: Number of images used for calibration
+    """
+    with tf.Graph().as_default(), tf.Session() as sess:
+        # float input already scaled the way convert_image_dtype scales the int8 training placeholder;
+        # inference mode is baked in so dropout needs no runtime switch
+        image_input = tf.placeholder(tf.float32, (1, image_shape[0], image_shape[1], 3), name='image_input')
+        model_output = tf.identity(layers(image_input, 3, False), name='output')
+
+        saver = tf.train.Saver()
+        saver.restore(sess, checkpoint)
+
+        converter = tf.lite.TFLiteConverter.from_session(sess, [image_input], [model_output])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = helper.gen_representative_dataset(data_dir, image_shape,
+                                                                              calibration_count)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+        with open(output_file, 'wb') as f:
+            f.write(converter.convert())
+    print("TFLite model saved in file: %s" % output_file)
+
+
 def _build_classification_signature(input_tensor, scores_tensor):
   """Helper function for building a classification SignatureDef."""
   input_tensor_info = tf.saved_model.utils.build_tensor_info(input_tensor)
@@ -199,4 +231,7 @@ def _build_classification_signature(input_tensor, scores_tensor):
       tf.saved_model.signature_constants.CLASSIFY_METHOD_NAME)
 
 if __name__ == '__main__':
-    run()
+    if len(sys.argv) > 1 and sys.argv[1] == 'export_tflite':
+        export_tflite('./model.ckpt', './model_int8.tflite', './data', (128, 128))
+    else:
+        run()
@@ -4,16 +4,62 @@ import tensorflow as tf
 import cv2
 import random
 import rospy
-import scipy.misc
 import model_trainer
+import helper
 import numpy as np
 import os
+import hashlib
+
+# TF 1.x builds can ship contrib.tensorrt without libnvinfer, in which case the import raises NotFoundError
+try:
+    from tensorflow.contrib import tensorrt as trt
+    trt_import_error = None
+except Exception as e:
+    trt = None
+    trt_import_error = e
+
+# number of training images used to calibrate the INT8 engine
+CALIBRATION_FRAMES = 100
+# calibrated INT8 engine cached next to the checkpoint, keyed by batch size and calibration set
+TRT_GRAPH = 'model_trt_int8_b{}_{}.pb'
+# input size of the classifier (width, height)
+CLASSIFIER_SHAPE = (128, 128)
+# INT8 TFLite export of the model used on targets without a GPU
+TFLITE_MODEL = 'model_int8.tflite'
+# largest input resized on the GPU; above this the host to device copy costs more than the resize
+CUDA_RESIZE_MAX_PIXELS = 640 * 480
 
 class TLClassifier(object):
     def __init__(self):
 
+        self.model_folder = rospy.get_param("/traffic_light_model_directory")
+
+        # number of frames classified per session run
+        self.batch_size = rospy.get_param('~classifier_batch_size', 1)
+
+        # input batch reused across frames; images are resized straight into it. The model was trained on
+        # an int8 placeholder, so it is fed through a zero-copy int8 view to keep the trained input scaling
+        self._feed = np.empty((self.batch_size, CLASSIFIER_SHAPE[1], CLASSIFIER_SHAPE[0], 3), dtype=np.uint8)
+        self._feed_int8 = self._feed.view(np.int8)
+
+        # resize on the GPU when OpenCV is built with CUDA
+        self.gpu_image = None
+        if hasattr(cv2, 'cuda') and cv2.cuda.getCudaEnabledDeviceCount() > 0:
+            self.gpu_image = cv2.cuda_GpuMat()
+
+        # on CPU-only targets run the INT8 TFLite export of the model if there is one (see model_trainer.py)
         self.sess = None
-        self.sess = tf.Session()
+        self.interpreter = None
+        tflite_file = os.path.join(self.model_folder, TFLITE_MODEL)
+        # probe for a GPU without creating a TF device, which would reserve its memory before allow_growth applies
+        gpu_visible = os.path.exists('/dev/nvidia0') and os.environ.get('CUDA_VISIBLE_DEVICES') not in ('', '-1')
+        if hasattr(tf, 'lite') and os.path.isfile(tflite_file) and rospy.get_param('~use_tflite', not gpu_visible):
+            self.load_tflite(tflite_file)
+            return
+
+        # don't reserve all GPU memory up front; other CUDA consumers share the device
+        self.session_config = tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))
+        self.sess = tf.Session(config=self.session_config)
 
         training_mode = tf.placeholder(tf.bool)
         image_input_placeholder = tf.placeholder(tf.int8, (None, 128, 128, 3))
@@ -22,29 +68,173 @@ class TLClassifier(object):
         # conv layers
         model_output = model_trainer.layers(image_input_layer, 3, training_mode)
 
-        self.model_folder = rospy.get_param("/traffic_light_model_directory")
-
         saver = tf.train.Saver()
         saver.restore(self.sess, self.model_folder + "model.ckpt")
 
-        for layer in [tensor.name for tensor in tf.get_default_graph().as_graph_def().node]:
-            rospy.loginfo(str(layer))
+        if rospy.get_param('~log_graph_nodes', False):
+            for layer in [tensor.name for tensor in tf.get_default_graph().as_graph_def().node]:
+                rospy.loginfo(str(layer))
+
+        # freeze the restored weights so the graph can be optimized for inference
+        frozen_graph = tf.graph_util.convert_variables_to_constants(self.sess, self.sess.graph.as_graph_def(),
+                                                                    [model_output.op.name])
+        self.sess.close()
+
+        tensor_names = [image_input_placeholder.name, training_mode.name, model_output.name]
+        inference_graph = self.optimize_graph(frozen_graph, model_output.op.name, tensor_names)
+
+        # build the inference ops once; adding them per frame would grow the graph on every call
+        graph = tf.Graph()
+        with graph.as_default():
+            self.image_tensor, self.training_mode, self.output_tensor = tf.import_graph_def(
+                inference_graph, return_elements=tensor_names, name='')
+            self.softmax_topk = tf.nn.top_k(tf.nn.softmax(self.output_tensor))
+        graph.finalize()
+        self.sess = tf.Session(graph=graph, config=self.session_config)
+
+    def load_tflite(self, tflite_file):
+        """
+        Load the TFLite model and size its input for a full batch
+        :param tflite_file: path of the .tflite file
+        """
+        self.interpreter = tf.lite.Interpreter(model_path=tflite_file)
+        self.tflite_input = self.interpreter.get_input_details()[0]
+        self.tflite_output = self.interpreter.get_output_details()[0]
+        self.interpreter.resize_tensor_input(self.tflite_input['index'], self._feed.shape)
+        self.interpreter.allocate_tensors()
+
+        # the export takes the input scaled as convert_image_dtype scales the int8 placeholder; a pixel has only
+        # 256 values, so precompute that scaling and the input quantization for each of them
+        dtype = self.tflite_input['dtype']
+        values = np.arange(256, dtype=np.uint8).view(np.int8) / np.float32(127.0)
+        if dtype != np.float32:
+            scale, zero_point = self.tflite_input['quantization']
+            limits = np.iinfo(dtype)
+            values = np.clip(np.round(values / scale + zero_point), limits.min, limits.max)
+        self._tflite_table = values.astype(dtype)
+        self._tflite_images = np.empty(self._feed.shape, dtype=dtype)
+        rospy.loginfo("TLClassifier: using TFLite model %s", tflite_file)
+
+    def run_tflite(self):
+        """
+        Run the TFLite model on the input buffer
+        :return: the detected class index for every slot of the input buffer
+        """
+        # the uint8 input buffer indexes the table with the bit pattern of each int8 pixel
+        images = np.take(self._tflite_table, self._feed, out=self._tflite_images, mode='clip')
+        self.interpreter.set_tensor(self.tflite_input['index'], images)
+        self.interpreter.invoke()
+        output = self.interpreter.get_tensor(self.tflite_output['index'])
+        return output.reshape(len(output), -1).argmax(axis=1)
+
+    def optimize_graph(self, frozen_graph, output_name, tensor_names):
+        """
+        Convert the frozen graph to a TensorRT INT8 engine, calibrated on the training images
+        :param frozen_graph: the frozen GraphDef of the classifier
+        :param output_name: name of the output node
+        :param tensor_names: names of the input image, training mode and output tensors
+        :return: the optimized GraphDef, or the frozen graph if TensorRT is unavailable
+        """
+        if trt is None:
+            rospy.logwarn("TLClassifier: TensorRT not available (%s), using the frozen graph", trt_import_error)
+            return frozen_graph
+
+        # calibrate on the same light crops as the TFLite export (see model_trainer.py)
+        data_folder = os.path.join(self.model_folder, 'data')
+        image_paths = helper.get_calibration_paths(data_folder, CALIBRATION_FRAMES)
+        if not image_paths:
+            rospy.logwarn("TLClassifier: no calibration images in %s, using the frozen graph", data_folder)
+            return frozen_graph
+
+        # reuse the engine calibrated on a previous start for the same batch size and calibration images, unless
+        # the checkpoint is newer
+        calibration_set = hashlib.md5(repr([(path, os.path.getmtime(path)) for path in image_paths]).encode())
+        trt_file = os.path.join(self.model_folder, TRT_GRAPH.format(self.batch_size, calibration_set.hexdigest()[:8]))
+        checkpoint_file = os.path.join(self.model_folder, 'model.ckpt.index')
+        if os.path.isfile(trt_file) and os.path.getmtime(trt_file) >= os.path.getmtime(checkpoint_file):
+            inference_graph = tf.GraphDef()
+            with open(trt_file, 'rb') as f:
+                inference_graph.ParseFromString(f.read())
+            rospy.loginfo("TLClassifier: loaded calibrated TensorRT engine %s", trt_file)
+            return inference_graph
+
+        calibration_graph = trt.create_inference_graph(input_graph_def=frozen_graph, outputs=[output_name],
+                                                       max_batch_size=self.batch_size, max_workspace_size_bytes=1 << 30,
+                                                       precision_mode='INT8')
+
+        # run the calibration frames through the graph to collect the INT8 ranges
+        with tf.Graph().as_default() as graph:
+            image_tensor, training_mode, output_tensor = tf.import_graph_def(
+                calibration_graph, return_elements=tensor_names, name='')
+            with tf.Session(graph=graph, config=self.session_config) as sess:
+                for image_path in image_paths:
+                    image = cv2.imread(image_path)
+                    if image is None:
+                        rospy.logwarn("TLClassifier: skipping unreadable calibration frame %s", image_path)
+                        continue
+                    self.resize(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), self._feed[0])
+                    sess.run(output_tensor, {training_mode: False, image_tensor: self._feed_int8[:1]})
+
+        inference_graph = trt.calib_graph_to_infer_graph(calibration_graph)
+        rospy.loginfo("TLClassifier: calibrated TensorRT engine on %d frames", len(image_paths))
+
+        # the model folder may be read-only on a deployed workspace; the engine is then recalibrated on each start
+        try:
+            tf.train.write_graph(inference_graph, self.model_folder, os.path.basename(trt_file), as_text=False)
+            rospy.loginfo("TLClassifier: saved calibrated TensorRT engine to %s", trt_file)
+        except Exception as e:
+            rospy.logwarn("TLClassifier: could not save calibrated TensorRT engine to %s (%s)", trt_file, e)
+        return inference_graph
+
+    def resize(self, image, dst):
+        """
+        Resize an image to the classifier input size. The result is written into a slot of the reusable input
+        buffer in a single pass; the dtype conversion is left to the graph.
+        :param image: the image to resize
+        :param dst: the input buffer slot to write to
+        :return: the resized image (a reference to dst)
+        """
+        if self.gpu_image is not None and image.shape[0] * image.shape[1] <= CUDA_RESIZE_MAX_PIXELS:
+            self.gpu_image.upload(image)
+            cv2.cuda.resize(self.gpu_image, CLASSIFIER_SHAPE, interpolation=cv2.INTER_AREA).download(dst)
+        else:
+            cv2.resize(image, CLASSIFIER_SHAPE, dst=dst, interpolation=cv2.INTER_AREA)
+        return dst
+
+    def get_classifications(self, images):
+        """
+        Classify a batch of images, running the session once per batch_size images
+        :param images: the images to classify
+        :return: list of IDs of traffic light color (specified in styx_msgs/TrafficLight), in input order
+        """
+        states = []
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start:start + self.batch_size]
+            for image, dst in zip(batch, self._feed):
+                self.resize(image, dst)
+
+            if self.interpreter is not None:
+                indices = self.run_tflite()[:len(batch)]
+            else:
+                results = self.sess.run(self.softmax_topk, {self.training_mode: False,
+                                                            self.image_tensor: self._feed_int8[:len(batch)]})
+                indices = np.array(results.indices).flatten()
+            states.extend(self.to_light_state(int(index)) for index in indices)
 
-        self.image_tensor = image_input_placeholder
-        self.training_mode = training_mode
-        self.output_tensor = model_output
-        pass
+        return states
 
     count = 0
     def get_classification(self, image, light_state):
 
         #run classifier
-        image_shape = (128, 128)
-        image = scipy.misc.imresize(image, image_shape)
+        return self.get_classifications([image])[0]
 
-        results = self.sess.run([tf.nn.top_k(tf.nn.softmax(self.output_tensor))],
-                           {self.training_mode: False, self.image_tensor: [image]})
-        detected_light_state = int(np.array(results[0].indices).flatten()[0])
+    def to_light_state(self, detected_light_state):
+        """
+        Map a class index of the model to a traffic light state
+        :param detected_light_state: the class index
+        :return: ID of traffic light color (specified in styx_msgs/TrafficLight)
+        """
 
         # if light_state != 4 and detected_light_state != light_state:
         #     image_id = random.randrange(0, 1000000)
@@ -59,13 +249,14 @@ class TLClassifier(object):
         if detected_light_state == 0:
             return TrafficLight.RED
         if detected_light_state == 1:
-            rospy.loginfo("Returning Yellow")
+            rospy.logdebug("Returning Yellow")
             return TrafficLight.YELLOW
         if detected_light_state == 2:
-            rospy.loginfo("Returning Green")
+            rospy.logdebug("Returning Green")
             return TrafficLight.GREEN
-        rospy.loginfo("Returning Unknown")
+        rospy.logdebug("Returning Unknown")
         return TrafficLight.UNKNOWN
 
     def close(self):
-        self.sess.close()
\ No newline at end of file
+        if self.sess is not None:
+            self.sess.close()
\ No newline at end of file
@@ -6,14 +6,15 @@ from geometry_msgs.msg import PoseStamped, Pose, Point
 from styx_msgs.msg import TrafficLightArray, TrafficLight
 from styx_msgs.msg import Lane
 from sensor_msgs.msg import Image
-from cv_bridge import CvBridge
 from light_classification.tl_classifier import TLClassifier
 import numpy as np
 import tf
 import cv2
 import yaml
 import math
-import scipy.misc
+import threading
+import time
+from scipy.spatial import cKDTree
 from tf.transformations import euler_from_quaternion
 
 STATE_COUNT_THRESHOLD = 3
@@ -25,22 +26,20 @@ class TLDetector(object):
         rospy.init_node('tl_detector')
 
         self.pose = None
-        self.base_waypoints = None
+        self.track = None  # (waypoints, kd-tree) of one map message
         self.camera_image = None
         self.lights = []
 
-        sub1 = rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb)
-        sub2 = rospy.Subscriber('/base_waypoints', Lane, self.base_waypoints_cb)
+        # classify at most once per period, which stretches to the last classification latency
+        self.min_classify_period = 1.0 / rospy.get_param('~classification_rate', 10.0)
+        self._classify_period = self.min_classify_period
+        self._last_classify_t = 0.0
+        self._busy = threading.Lock()
 
-        '''
-        /vehicle/traffic_lights provides you with the location of the traffic light in 3D map space and
-        helps you acquire an accurate ground truth data source for the traffic light
-        classifier by sending the current color state of all traffic lights in the
-        simulator. When testing on the vehicle, the color state will not be available. You'll need to
-        rely on the position of the light and the camera image to predict it.
-        '''
-        sub3 = rospy.Subscriber('/vehicle/traffic_lights', TrafficLightArray, self.traffic_cb, buff_size=1000000, queue_size=1)
-        sub6 = rospy.Subscriber('/image_color', Image, self.image_cb, buff_size=8000000, queue_size=1)
+        # camera frames waiting to be classified as one batch
+        self.max_batch_wait = rospy.get_param('~classifier_batch_wait', 0.5)
+        self._pending = []
+        self._pending_since = 0.0
 
         config_string = rospy.get_param("/traffic_light_config")
         self.config = yaml.load(config_string)
@@ -48,34 +47,46 @@ class TLDetector(object):
         # register publisher to broadcast traffic waypoint
         self.upcoming_red_light_pub = rospy.Publisher('/traffic_waypoint', Int32, queue_size=1)
 
-        self.bridge = CvBridge()
-
         self.listener = tf.TransformListener()
 
-        # set defaults and params
+        # set defaults and params; the latched map can arrive as soon as its subscriber exists, so everything
+        # base_waypoints_cb touches is set first
         self.state = TrafficLight.UNKNOWN
         self.last_state = TrafficLight.UNKNOWN
         self.last_wp = -1
         self.state_count = 0
         self.traffic_map = {}
+        self.stop_lines = None
+
+        sub1 = rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb)
+        sub2 = rospy.Subscriber('/base_waypoints', Lane, self.base_waypoints_cb)
+
+        '''
+        /vehicle/traffic_lights provides you with the location of the traffic light in 3D map space and
+        helps you acquire an accurate ground truth data source for the traffic light
+        classifier by sending the current color state of all traffic lights in the
+        simulator. When testing on the vehicle, the color state will not be available. You'll need to
+        rely on the position of the light and the camera image to predict it.
+        '''
+        sub3 = rospy.Subscriber('/vehicle/traffic_lights', TrafficLightArray, self.traffic_cb, buff_size=1000000, queue_size=1)
+        sub6 = rospy.Subscriber('/image_color', Image, self.image_cb, buff_size=2**24, queue_size=1)
 
         self.light_classifier = TLClassifier()
         self.started = True
         self.image_processed = True
         rospy.spin()
 
-    def distance(self, pose1, pose2):
+    def squared_distance(self, pose1, pose2):
         """
-        To calculate the distance between two poses
+        To calculate the squared distance between two poses; enough when distances are only compared
         :param pose1 (Point): the origin
         :param pose2 (Point): the target
-        :return: distance between the poses
+        :return: squared distance between the poses
         """
-        xcomp = math.pow(pose2.x - pose1.x, 2)
-        ycomp = math.pow(pose2.y - pose1.y, 2)
-        zcomp = math.pow(pose2.z - pose1.z, 2)
-        dist = math.sqrt(xcomp + ycomp + zcomp)
-        return dist
+        dx = pose2.x - pose1.x
+        dy = pose2.y - pose1.y
+        dz = pose2.z - pose1.z
+        return dx * dx + dy * dy + dz * dz
 
     def get_closest_waypoint(self, pose):
         """Identifies the closest path waypoint to the given position
@@ -85,19 +96,12 @@ class TLDetector(object):
         Returns:
             int: index of the closest waypoint in self.waypoints
         """
-        best = sys.float_info.max
-        closest = 0
-
-        if not self.base_waypoints:
-            return -1
-        for idx, wp in enumerate(self.base_waypoints.waypoints):
-            waypoint_position = wp.pose.pose.position
-            dist = self.distance(pose.position, waypoint_position)
-            if dist < best:
-                closest = idx
-                best = dist
+        if self.track is None:
+            return -1, sys.float_info.max
+        _, tree = self.track
 
-        return closest, best
+        dist, closest = tree.query([pose.position.x, pose.position.y])
+        return int(closest), dist
 
     def load_traffic_map(self):
         """
@@ -105,18 +109,25 @@ class TLDetector(object):
         :return: None
         """
         # check if base waypoints are set
-        if self.base_waypoints is None:
+        if self.track is None:
             rospy.logwarn("TLDetector: Trying to load nearest waypoints before receiving base waypoints/light positions")
             return None
 
         # for each stop line position get the nearest waypoint and store in a dict
+        traffic_map = {}
         for light in self.config['stop_line_positions']:
             pose = Pose()
             pose.position.x = light[0]
             pose.position.y = light[1]
             pose.position.z = 0.0
             closest_waypoint, _ = self.get_closest_waypoint(pose)
-            self.traffic_map[closest_waypoint] = pose
+            traffic_map[closest_waypoint] = pose
+        self.traffic_map = traffic_map
+
+        # index the stop lines so the nearest ones to the car can be queried directly
+        entries = list(traffic_map.items())
+        if entries:
+            self.stop_lines = (cKDTree([[pose.position.x, pose.position.y] for _, pose in entries]), entries)
 
     def is_behind(self, pose, target_wp):
         """
@@ -153,29 +164,29 @@ class TLDetector(object):
         :return: the closest traffic waypoint, its index
         """
 
-        # get the origin waypoint and traffic map
-        origin_wp = self.base_waypoints.waypoints[origin_idx]
-        traffic_map = dict(self.traffic_map)
-
-        # check the traffic signal closest and ahead of the origin
-        best_distance = float('inf')
-        best_tl = None
-        best_wp_idx = None
-        for target_idx, pose in traffic_map.iteritems():
-            distance = self.distance(origin_wp.pose.pose.position, pose.position)
-            if distance < best_distance:
-                # if waypoint is behind, skip
-                if self.is_behind(origin_wp.pose.pose, self.base_waypoints.waypoints[target_idx]):
-                    continue
-                best_distance = distance
-                best_tl = pose
-                best_wp_idx = target_idx
-
-        # check if traffic light is visible
-        if best_distance > VISIBLE_DISTANCE:
+        # the stop lines are only indexed once the map is loaded
+        if self.stop_lines is None:
             return None, -1
-
-        return best_tl, best_wp_idx
+        tree, entries = self.stop_lines
+        waypoints = self.track[0].waypoints
+
+        # get the origin waypoint and stop line index
+        origin_wp = waypoints[origin_idx]
+        origin_position = origin_wp.pose.pose.position
+
+        # check the visible stop lines in order of distance; the first one ahead of the origin is the closest
+        distances, indices = tree.query([origin_position.x, origin_position.y], k=len(entries),
+                                        distance_upper_bound=VISIBLE_DISTANCE)
+        for distance, idx in zip(np.atleast_1d(distances), np.atleast_1d(indices)):
+            if np.isinf(distance):
+                break
+            target_idx, pose = entries[idx]
+            # if waypoint is behind, skip
+            if self.is_behind(origin_wp.pose.pose, waypoints[target_idx]):
+                continue
+            return pose, target_idx
+
+        return None, -1
 
     def get_closest_light(self, light_pose):
         """
@@ -186,7 +197,7 @@ class TLDetector(object):
         best_dist = float('inf')
         closest_light = None
         for light in self.lights:
-            distance = self.distance(light_pose.position, light.pose.pose.position)
+            distance = self.squared_distance(light_pose.position, light.pose.pose.position)
             if distance < best_dist:
                 best_dist = distance
                 closest_light = light
@@ -209,7 +220,9 @@ class TLDetector(object):
         :param waypoints: the incoming message
         :return: None
         """
-        self.base_waypoints = waypoints
+        xy = [[wp.pose.pose.position.x, wp.pose.pose.position.y] for wp in waypoints.waypoints]
+        # publish the waypoints together with their lookup in a single assignment
+        self.track = (waypoints, cKDTree(xy))
         self.load_traffic_map()
 
     def traffic_cb(self, msg):
@@ -237,7 +250,7 @@ class TLDetector(object):
 
     def update_lights(self):
         if (not self.pose) or (not self.pose.pose) or (not self.camera_image):
-            rospy.logwarn('state missing for light update')
+            rospy.logwarn_throttle(1.0, 'state missing for light update')
             return
 
         if self.image_processed:
@@ -248,19 +261,39 @@ class TLDetector(object):
             rospy.logdebug("skipping light update - image and position not in synch")
             return
 
-        #possible race condition here. Can have multiple threads hit this. I need to put a 2.7 compatable lock here.
-        self.image_processed = True
-        rospy.logdebug("Updating traffic light")
-        light_wp, state = self.process_traffic_lights()
+        # drop the frame if the classifier is still busy or ran too recently
+        if time.time() - self._last_classify_t < self._classify_period:
+            rospy.logdebug("skipping light update - classifier rate limit")
+            return
+
+        if not self._busy.acquire(False):
+            rospy.logdebug("skipping light update - classifier busy")
+            return
+
+        try:
+            # another thread may have processed the image while we waited
+            if self.image_processed:
+                return
+
+            self.image_processed = True
+            rospy.logdebug("Updating traffic light")
+            start = time.time()
+            results = self.process_traffic_lights()
+            self._last_classify_t = start
+            self._classify_period = max(self.min_classify_period, time.time() - start)
+
+            for light_wp, state in results:
+                self.publish_light_state(light_wp, state)
+        finally:
+            self._busy.release()
+
+    def publish_light_state(self, light_wp, state):
         '''
             Publish upcoming red lights at camera frequency.
             Each predicted state has to occur `STATE_COUNT_THRESHOLD` number
             of times till we start using it. Otherwise the previous stable state is
             used.
             '''
-
-
-
         if self.state != state:
             self.state_count = 0
             self.state = state
@@ -309,7 +342,7 @@ class TLDetector(object):
                                                            "/world", now)
 
         except (tf.Exception, tf.LookupException, tf.ConnectivityException):
-            rospy.logerr("Failed to find camera to map transform")
+            rospy.logerr_throttle(1.0, "Failed to find camera to map transform")
             return None, None, None, None, None, None
 
         # get car orientation - yaw
@@ -357,50 +390,102 @@ class TLDetector(object):
 
         return [top_x, top_y, bottom_x, bottom_y, center_x, center_y]
 
-    def get_light_state(self, light):
-        """Determines the current color of the traffic light
-        Args:
-            light (TrafficLight): light to classify
-        Returns:
-            int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+    def get_light_image(self, light):
+        """
+        Crops the traffic light out of the current camera image
+        :param light: the light to crop
+        :return: the cropped image; None if there is no image or the light is outside of it
         """
         if (not self.has_image):
             self.prev_light_loc = None
-            return False
+            return None
+
+        image_msg = self.camera_image
+        if image_msg.encoding not in ('rgb8', 'bgr8'):
+            rospy.logwarn_throttle(1.0, "TLDetector: unsupported image encoding %s" % image_msg.encoding)
+            return None
 
-        cv_image = self.bridge.imgmsg_to_cv2(self.camera_image, "rgb8")
+        # view the message payload as an image without copying it; rows may be padded to the step size
+        cv_image = np.ndarray((image_msg.height, image_msg.width, 3), dtype=np.uint8, buffer=image_msg.data,
+                              strides=(image_msg.step, 3, 1))
 
         # mycoords
         [top_x, top_y, bottom_x, bottom_y, center_x, center_y] = self.project_to_image_plane(light.pose.pose.position)
         if top_x < 0 or top_y < 0 or bottom_y >= 600 or bottom_x >= 800:
-            return False
+            return None
 
-        # preprocess the image
+        # crop the light; the classifier resizes it to its input shape
         croppedImage = cv_image[top_y:bottom_y, top_x:bottom_x]
-        classifier_shape = (128, 128)
-        final_image = scipy.misc.imresize(croppedImage, classifier_shape)
-
-        # Get classification of the pre-processed image
-        return self.light_classifier.get_classification(final_image, light.state)
+        if image_msg.encoding == 'bgr8':
+            croppedImage = cv2.cvtColor(croppedImage, cv2.COLOR_BGR2RGB)
+        return croppedImage
 
     def process_traffic_lights(self):
         """Finds closest visible traffic light, if one exists, and determines its
             location and color
         Returns:
-            int: index of waypoint closes to the upcoming stop line for a traffic light (-1 if none exists)
-            int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+            list: (light_wp, state) pairs ready to publish, in frame order; empty while a batch is filling
+                int: index of waypoint closes to the upcoming stop line for a traffic light (-1 if none exists)
+                int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+        """
+        # only decode the image and run the classifier when a light is in range
+        light, light_wp = self._find_candidate_light()
+        if light is None:
+            rospy.logdebug("TLDetector: Traffic Light not found")
+            return self._flush_batch() + [(-1, TrafficLight.UNKNOWN)]
+
+        return self._classify(light, light_wp)
+
+    def _find_candidate_light(self):
+        """
+        Finds the closest visible traffic light ahead of the car using the waypoint geometry only
+        :return: the closest reported light and the waypoint index of its stop line; (None, -1) if none is visible
         """
         car_wp_idx, _ = self.get_closest_waypoint(self.pose.pose)
+
         traffic_pose, traffic_idx = self.get_closest_traffic_light(car_wp_idx)
-        if traffic_idx != -1:
-            rospy.logdebug("TLDetector: Traffic Light at {}".format(traffic_idx))
-            light = self.get_closest_light(traffic_pose)
-            state = self.get_light_state(light)
+        if traffic_idx == -1:
+            return None, -1
+
+        rospy.logdebug("TLDetector: Traffic Light at %s", traffic_idx)
+        light = self.get_closest_light(traffic_pose)
+        if light is None:
+            return None, -1
+
+        return light, traffic_idx
 
-            return traffic_idx, state
+    def _classify(self, light, light_wp):
+        """
+        Queues the current camera image of a candidate traffic light and classifies the queued frames in one
+        batch once it is full or its oldest frame has waited too long
+        :param light: the light to classify
+        :param light_wp: the waypoint index of the light's stop line
+        :return: list of classified (light_wp, state) pairs, in frame order
+        """
+        image = self.get_light_image(light)
+        if image is None:
+            return self._flush_batch() + [(light_wp, TrafficLight.UNKNOWN)]
+
+        if not self._pending:
+            self._pending_since = time.time()
+        self._pending.append((light_wp, image))
+
+        if len(self._pending) >= self.light_classifier.batch_size or \
+                time.time() - self._pending_since >= self.max_batch_wait:
+            return self._flush_batch()
+        return []
+
+    def _flush_batch(self):
+        """
+        Classifies all queued frames in a single batch
+        :return: list of classified (light_wp, state) pairs, in frame order
+        """
+        if not self._pending:
+            return []
 
-        rospy.loginfo("TLDetector: Traffic Light not found")
-        return -1, TrafficLight.UNKNOWN
+        light_wps, images = zip(*self._pending)
+        self._pending = []
+        return list(zip(light_wps, self.light_classifier.get_classifications(images)))
 
     def create_pose(self, x, y, z, yaw=0.0):
         """
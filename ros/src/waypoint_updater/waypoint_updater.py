@@ -8,9 +8,18 @@ import rospy
 from geometry_msgs.msg import PoseStamped, TwistStamped
 from styx_msgs.msg import Lane, Waypoint
 from std_msgs.msg import Int32
-from tf.transformations import euler_from_quaternion
 
-import math
+from math import sqrt, cos, sin, atan2
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 '''
 This node will publish waypoints from the car's current position to some `x` distance ahead.
@@ -27,6 +36,40 @@ LOOKAHEAD_WPS = 25  # Number of waypoints we will publish. You can change this n
 KPH_MPS = 0.277778  # change from 1 KPH to 1 MPH
 WAIT_TIME = 10.0
 SAFE_ACCEL = 1
+PUBLISH_RATE = 10  # Hz
+SEARCH_BEHIND = 5  # waypoints searched behind the last closest waypoint
+SEARCH_AHEAD = 64  # waypoints searched ahead of the last closest waypoint
+SEARCH_MAX_DIST = 5.0  # farthest the car can be from the closest waypoint of the window before searching all
+
+
+@njit(cache=True)
+def _closest_in_window(xyz, px, py, pz, lo, hi):
+    """
+    Find the closest waypoint to a position among the indices [lo, hi), wrapping around the end of the track
+    :param xyz: the N x 3 array of waypoint positions
+    :param px: the x co-ordinate of the position
+    :param py: the y co-ordinate of the position
+    :param pz: the z co-ordinate of the position
+    :param lo: the first index of the window
+    :param hi: the index past the end of the window
+    :return: the index of the closest waypoint and its squared distance
+    """
+    num_waypoints = xyz.shape[0]
+    closest_index = lo % num_waypoints
+    dx = xyz[closest_index, 0] - px
+    dy = xyz[closest_index, 1] - py
+    dz = xyz[closest_index, 2] - pz
+    closest_dist2 = dx * dx + dy * dy + dz * dz
+    for i in range(lo + 1, hi):
+        j = i % num_waypoints
+        dx = xyz[j, 0] - px
+        dy = xyz[j, 1] - py
+        dz = xyz[j, 2] - pz
+        dist2 = dx * dx + dy * dy + dz * dz
+        if dist2 < closest_dist2:
+            closest_index = j
+            closest_dist2 = dist2
+    return closest_index, closest_dist2
 
 
 class WaypointUpdater(object):
@@ -46,9 +89,9 @@ class WaypointUpdater(object):
         self.final_waypoints_pub = rospy.Publisher('final_waypoints', Lane, queue_size=1)
 
         # initialize track states
-        self.base_waypoints = None
-        self.pose = None
-        self.last_waypoint = None
+        self.track = None  # (waypoints, positions) of one waypoints message
+        self.pose = None  # (pose message, cos yaw, sin yaw) of the latest pose
+        self.last_waypoint = (None, None)  # (track, index) of the last closest waypoint
         self.traffic_wp_ind = None
         self.current_speed = 0.0
 
@@ -63,23 +106,20 @@ class WaypointUpdater(object):
         self.traffic_received_time = None
         self.apply_brake = False
 
-        # start the loop
-        self.loop()
+        # publish the waypoints periodically from a timer; ROS handles incoming messages between ticks
+        self.timer = rospy.Timer(rospy.Duration(1.0 / PUBLISH_RATE), self._tick)
+        rospy.spin()
 
-    def __is_behind(self, pose, target_wp):
+    def __is_behind(self, pose, cos_yaw, sin_yaw, target_wp):
         """
         To determine if the target waypoint is behind the car
         :param pose: the pose of the car
+        :param cos_yaw: the cosine of the car's yaw
+        :param sin_yaw: the sine of the car's yaw
         :param target_wp: the target waypoint
         :return: bool True if waypoint is behind else False
         """
 
-        # get the yaw angle after transformation
-        _, _, yaw = euler_from_quaternion([pose.orientation.x,
-                                           pose.orientation.y,
-                                           pose.orientation.z,
-                                           pose.orientation.w])
-
         origin_x = pose.position.x
         origin_y = pose.position.y
 
@@ -87,116 +127,133 @@ class WaypointUpdater(object):
         shift_x = target_wp.pose.pose.position.x - origin_x
         shift_y = target_wp.pose.pose.position.y - origin_y
 
-        # rotate and check orientation
-        x = (shift_x * math.cos(0.0 - yaw)) - (shift_y * math.sin(0.0 - yaw))
-        if x > 0.0:
-            return False
-        return True
+        # rotate by the yaw of the pose and check orientation
+        x = shift_x * cos_yaw + shift_y * sin_yaw
+        return x <= 0.0
 
-    def __get_closest_waypoint(self, pose):
+    def __get_closest_waypoint(self, pose, cos_yaw, sin_yaw, waypoints, xyz, last_waypoint):
         """
         Get the closest waypoint from the car's current pose
         :param pose: the pose of the car
+        :param cos_yaw: the cosine of the car's yaw
+        :param sin_yaw: the sine of the car's yaw
+        :param waypoints: the list of base waypoints
+        :param xyz: the N x 3 array of the base waypoint positions
+        :param last_waypoint: the closest waypoint of the last update; None if unknown
         :return: the closest waypoint ahead of the car
         """
 
-        num_waypoints = len(self.base_waypoints)
-
-        # calculate the nearest waypoint by temporarily storing shortest distance
-        closest_index = 0
-        closest_waypoint = None
-        closest_distance = float('inf')
-
-        # check if we have a known last point; if found lopp from it to improve performance
-        if self.last_waypoint:  # will happen every time except for the first time.
-            for i in range(num_waypoints):
-                this_index = (i + self.last_waypoint) % num_waypoints
-                waypoint = self.base_waypoints[this_index]
-                this_distance = self.euclidean_distance(waypoint.pose.pose.position, pose.position)
-                if this_distance < closest_distance:
-                    closest_index = this_index
-                    closest_waypoint = waypoint
-                    closest_distance = this_distance
-                else:  # we are now getting further away, stop
-                    break
-        # iterate through all waypoints initially
-        else:
-            for i, waypoint in enumerate(self.base_waypoints):
-                this_distance = self.euclidean_distance(waypoint.pose.pose.position, pose.position)
-                if this_distance < closest_distance:
-                    closest_index = i
-                    closest_waypoint = waypoint
-                    closest_distance = this_distance
+        num_waypoints = len(waypoints)
+        px, py, pz = pose.position.x, pose.position.y, pose.position.z
+        position = np.array([px, py, pz], dtype=np.float32)
+
+        # check if we have a known last point; if found search a small window around it, since the car only
+        # moves a few waypoints per update
+        closest_index = None
+        if last_waypoint is not None:  # will happen every time except for the first time.
+            lo = last_waypoint - SEARCH_BEHIND
+            hi = last_waypoint + SEARCH_AHEAD
+            if NUMBA_AVAILABLE:
+                closest_index, closest_dist2 = _closest_in_window(xyz, px, py, pz, lo, hi)
+            elif lo >= 0 and hi <= num_waypoints:
+                diff = xyz[lo:hi] - position
+                dist2 = np.einsum('ij,ij->i', diff, diff)
+                i = int(dist2.argmin())
+                closest_index, closest_dist2 = lo + i, dist2[i]
+            # the window wraps around the end of the track
+            else:
+                indices = np.arange(lo, hi) % num_waypoints
+                diff = xyz[indices] - position
+                dist2 = np.einsum('ij,ij->i', diff, diff)
+                i = int(dist2.argmin())
+                closest_index, closest_dist2 = int(indices[i]), dist2[i]
+
+            # a minimum on the edge of the window or far from the car means the car has left the window, e.g.
+            # after a reset or relocation of the car
+            if closest_index in (lo % num_waypoints, (hi - 1) % num_waypoints) or \
+                    closest_dist2 > SEARCH_MAX_DIST * SEARCH_MAX_DIST:
+                closest_index = None
+
+        # search through all waypoints initially and whenever the window lost the car
+        if closest_index is None:
+            diff = xyz - position
+            closest_index = int(np.einsum('ij,ij->i', diff, diff).argmin())
+        closest_waypoint = waypoints[closest_index]
 
         # check if closest waypoint is behind the car
-        if self.__is_behind(pose, closest_waypoint):
+        if self.__is_behind(pose, cos_yaw, sin_yaw, closest_waypoint):
             closest_index += 1
 
         return closest_index
 
-    def __get_traffic_wp(self, closest_index):
+    def __get_traffic_wp(self, closest_index, num_waypoints):
         """
         To get a valid traffic waypoint index ahead of the car
         :param closest_index: the index of the waypoint near the car
+        :param num_waypoints: the number of base waypoints
         :return: the traffic waypoint index; -1 if no traffic waypoints ahead
         """
         # check if we received a traffic waypoint index
         if self.traffic_wp_ind is not None and self.traffic_wp_ind != -1:
             # check if the traffic index is ahead of the planned route
-            for i in range(LOOKAHEAD_WPS):
-                new_index = (i + closest_index) % len(self.base_waypoints)
-                if new_index == self.traffic_wp_ind:
-                    return self.traffic_wp_ind
+            if 0 <= self.traffic_wp_ind < num_waypoints and \
+                    (self.traffic_wp_ind - closest_index) % num_waypoints < LOOKAHEAD_WPS:
+                return self.traffic_wp_ind
 
         # not found
         return -1
 
-    def loop(self):
+    def _tick(self, event):
         """
-        Loop to publish the waypoints and recommended speed
+        Timer callback to publish the waypoints and recommended speed
+        :param event: the timer event
         :return: None
         """
-        # limit publishing to 30 per second
-        rate = rospy.Rate(10)
-        while not rospy.is_shutdown():
-
-            # check if states are available
-            if self.base_waypoints is None or self.pose is None:
-                continue
-
-            # get the current pose of the car
-            pose = self.pose.pose
-            header = self.pose.header
-
-            # get the closest waypoint to the car's position
-            closest_idx = self.__get_closest_waypoint(pose)
-            last_index = closest_idx + LOOKAHEAD_WPS
-
-            # get the traffic waypoint index
-            traffic_wp_ind = self.__get_traffic_wp(closest_idx)
-
-            # check if car has to brake
-            if traffic_wp_ind != -1 and traffic_wp_ind is not None:
-                self.apply_brake = True
-            else:
-                self.apply_brake = False
+        # check if states are available
+        track = self.track
+        if track is None:
+            rospy.logwarn_throttle(5.0, "Original waypoints not yet loaded. Cannot publish final waypoints.")
+            return
+        car = self.pose
+        if car is None:
+            return
+        waypoints, xyz = track
+
+        # the last closest waypoint only indexes the track it was found on
+        last_track, last_waypoint = self.last_waypoint
+        if last_track is not track:
+            last_waypoint = None
+
+        # get the current pose of the car
+        msg, cos_yaw, sin_yaw = car
+        pose = msg.pose
+        header = msg.header
+
+        # get the closest waypoint to the car's position
+        closest_idx = self.__get_closest_waypoint(pose, cos_yaw, sin_yaw, waypoints, xyz, last_waypoint)
+        last_index = closest_idx + LOOKAHEAD_WPS
+
+        # get the traffic waypoint index
+        traffic_wp_ind = self.__get_traffic_wp(closest_idx, len(waypoints))
+
+        # check if car has to brake
+        if traffic_wp_ind != -1 and traffic_wp_ind is not None:
+            self.apply_brake = True
+        else:
+            self.apply_brake = False
 
-            # generate the next set of waypoints and set the speed for the waypoints
-            next_waypoints = self.__generate_next_waypoints(pose, self.base_waypoints, closest_idx, last_index,
-                                                            traffic_wp_ind)
+        # generate the next set of waypoints and set the speed for the waypoints
+        next_waypoints = self.__generate_next_waypoints(pose, waypoints, xyz, closest_idx, last_index,
+                                                        traffic_wp_ind)
 
-            # get the lane object
-            lane = self.__get_lane(header, next_waypoints)
-            
-            # publish the waypoints
-            self.final_waypoints_pub.publish(lane)
+        # get the lane object
+        lane = self.__get_lane(header, next_waypoints)
 
-            # save the last
-            self.last_waypoint = closest_idx
+        # publish the waypoints
+        self.final_waypoints_pub.publish(lane)
 
-            rate.sleep()
-        else:
-            rospy.logwarn("Original waypoints not yet loaded. Cannot publish final waypoints.")
+        # save the last
+        self.last_waypoint = (track, closest_idx)
 
     def pose_cb(self, msg):
         """
@@ -204,14 +261,19 @@ class WaypointUpdater(object):
         :param msg: incoming message, contains pose data
         :return: None
         """
-        self.pose = msg
+        # cache the heading of the car with the pose it belongs to; closed form yaw of the quaternion
+        orientation = msg.pose.orientation
+        yaw = atan2(2.0 * (orientation.w * orientation.z + orientation.x * orientation.y),
+                    1.0 - 2.0 * (orientation.y * orientation.y + orientation.z * orientation.z))
+        self.pose = (msg, cos(yaw), sin(yaw))
         self.pose_received_time = rospy.Time.now()
 
-    def __generate_next_waypoints(self, pose, waypoints, closest_idx, last_idx, traffic_idx=-1):
+    def __generate_next_waypoints(self, pose, waypoints, xyz, closest_idx, last_idx, traffic_idx=-1):
         """
         Method to generate and set the desired speed for the next waypoints
         :param pose: the current pose of the car
         :param waypoints: the list of target waypoints
+        :param xyz: the N x 3 array of the target waypoint positions
         :param closest_idx: the waypoint close to the car
         :param last_idx: the final waypoint
         :param traffic_idx: the traffic waypoint
@@ -226,55 +288,50 @@ class WaypointUpdater(object):
         current_speed = self.current_speed
         brake = self.apply_brake
         speed_limit = self.max_vel * KPH_MPS
-        next_waypoints = []
+        num_waypoints = len(waypoints)
+
+        # slice out the waypoints ahead, wrapping around the end of the track
+        indices = np.arange(closest_idx, last_idx) % num_waypoints
+        start = closest_idx if closest_idx < num_waypoints else closest_idx - num_waypoints
+        end = start + len(indices)
+        next_waypoints = waypoints[start:end] + waypoints[:max(0, end - num_waypoints)]
 
         # if braking is not required; set incremental speeds with safe acceleration
         if not brake:
-            for i in range(closest_idx, last_idx):
-                wp = waypoints[i % len(self.base_waypoints)]
-                current_speed = min(current_speed + SAFE_ACCEL, speed_limit)
-                self.set_waypoint_velocity(wp, current_speed)
-                next_waypoints.append(wp)
+            speeds = np.minimum(current_speed + SAFE_ACCEL * np.arange(1, len(indices) + 1), speed_limit)
+            for wp, speed in zip(next_waypoints, speeds.tolist()):
+                wp.twist.twist.linear.x = speed
             return next_waypoints
 
         # if braking is required then validate traffic waypoint
         if traffic_idx == -1:
-            rospy.logwarn("WaypointUpdater: Trying to brake while there is no traffic signal")
+            rospy.logwarn_throttle(1.0, "WaypointUpdater: Trying to brake while there is no traffic signal")
             return []
 
         # calculate the distance under which braking has to be done and the braking power
-        traffic_wp = self.base_waypoints[traffic_idx % len(self.base_waypoints)]
+        traffic_wp = waypoints[traffic_idx]
         stop_distance = self.euclidean_distance(pose.position, traffic_wp.pose.pose.position)
         brake_coeff = min(stop_distance, self.braking_distance) / self.current_speed
 
-        # set decremental speeds based on the distance from stop line
-        traffic_idx_found = False
-        for i in range(closest_idx, last_idx):
-            idx = i % len(self.base_waypoints)
-            wp = waypoints[idx]
-            if not traffic_idx_found:
-                wp_distance = self.euclidean_distance(wp.pose.pose.position, traffic_wp.pose.pose.position)
-                # if traffic waypoint index set speed to 0
-                if idx == traffic_idx:
-                    self.set_waypoint_velocity(wp, 0)
-                    traffic_idx_found = True
-                # if distance is greater than mimimum stopping distance continue accelerating
-                elif wp_distance > self.braking_distance:
-                    current_speed = min(current_speed + SAFE_ACCEL * 0.25, speed_limit)
-                    self.set_waypoint_velocity(wp, current_speed)
-                else:
-                    # if distance is greater than stop distance creep along
-                    if wp_distance > self.stop_distance:
-                        rec_speed = self.creep_speed
-                    else:
-                        # reduce speed based on distance from stop line
-                        decelerate = brake_coeff * (self.braking_distance - wp_distance)
-                        rec_speed = self.current_speed - decelerate
-                    self.set_waypoint_velocity(wp, rec_speed)
-            else:  # set speed as 0 for all waypoints after stop line
-                self.set_waypoint_velocity(wp, 0)
-
-            next_waypoints.append(wp)
+        # distance of each waypoint from the stop line
+        diff = xyz[indices] - xyz[traffic_idx]
+        wp_distances = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+        # if distance is greater than mimimum stopping distance continue accelerating
+        accelerate = wp_distances > self.braking_distance
+        ramp = current_speed + SAFE_ACCEL * 0.25 * np.cumsum(accelerate)
+        # if distance is greater than stop distance creep along, else reduce speed based on distance from stop line
+        decelerate = self.current_speed - brake_coeff * (self.braking_distance - wp_distances)
+        speeds = np.where(accelerate, ramp, np.where(wp_distances > self.stop_distance, self.creep_speed, decelerate))
+        speeds = np.minimum(speeds, speed_limit)
+
+        # set speed as 0 at the traffic waypoint and for all waypoints after it
+        stop_at = np.flatnonzero(indices == traffic_idx)
+        if len(stop_at):
+            speeds[stop_at[0]:] = 0.0
+
+        for wp, speed in zip(next_waypoints, speeds.tolist()):
+            wp.twist.twist.linear.x = speed
 
         return next_waypoints
 
@@ -297,7 +354,10 @@ class WaypointUpdater(object):
         :param msg: incoming message, contains waypoints
         :return: None
         """
-        self.base_waypoints = msg.waypoints
+        xyz = np.asarray([[wp.pose.pose.position.x, wp.pose.pose.position.y, wp.pose.pose.position.z]
+                          for wp in msg.waypoints], dtype=np.float32)
+        # swap the waypoints and their positions in together; _tick unpacks them once per update
+        self.track = (msg.waypoints, xyz)
 
     def traffic_cb(self, msg):
         '''
@@ -324,21 +384,10 @@ class WaypointUpdater(object):
     def get_waypoint_velocity(self, waypoint):
         return waypoint.twist.twist.linear.x
 
-    def set_waypoint_velocity(self, waypoint, velocity):
-        """
-        Sets the desired velocity for the waypoint. Thresholds the max value to the speed limit
-        :param waypoint: the waypoint to set the speed for
-        :param velocity: the desired speed
-        :return: None
-        """
-        safe_speed = min(velocity, self.max_vel * KPH_MPS)
-        waypoint.twist.twist.linear.x = safe_speed
-
     def distance(self, waypoints, wp1, wp2):
         dist = 0
-        dl = lambda a, b: math.sqrt((a.x - b.x) ** 2 + (a.y - b.y) ** 2 + (a.z - b.z) ** 2)
         for i in range(wp1, wp2 + 1):
-            dist += dl(waypoints[wp1].pose.pose.position, waypoints[i].pose.pose.position)
+            dist += self.euclidean_distance(waypoints[wp1].pose.pose.position, waypoints[i].pose.pose.position)
             wp1 = i
         return dist
 
@@ -349,7 +398,10 @@ class WaypointUpdater(object):
         :param p2: the position of the second way point
         :return: the distance between the two poses
         """
-        return math.sqrt(math.pow(p1.x - p2.x, 2) + math.pow(p1.y - p2.y, 2) + math.pow(p1.z - p2.z, 2))
+        dx = p1.x - p2.x
+        dy = p1.y - p2.y
+        dz = p1.z - p2.z
+        return sqrt(dx * dx + dy * dy + dz * dz)
 
 
 if __name__ == '__main__':